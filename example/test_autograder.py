@@ -34,8 +34,14 @@ if __name__ == "__main__":
 
     def test_num_lines(result: CustomTestResult):
         line_count = 0
-        with open("./palindrome.c", "r") as fp:
-            line_count = len(fp.readlines())
+        last = b"\n"
+        with open("./palindrome.c", "rb") as fp:
+            for block in iter(lambda: fp.read(65536), b""):
+                line_count += block.count(b"\n")
+                last = block[-1:]
+        if last != b"\n":
+            # A last line without a newline still counts, as in readlines().
+            line_count += 1
 
         if line_count > 20:
             result.passed = False
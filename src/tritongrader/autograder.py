@@ -12,7 +12,9 @@ from tritongrader.test_case import (
     BasicTestCase,
     CustomTestCase,
     CustomTestResult,
+    run_suite,
 )
+from tritongrader.cache import ResultCache
 
 logger = logging.getLogger("tritongrader.autograder")
 
@@ -38,10 +40,19 @@ class Autograder:
         compile_points: int = 0,
         missing_files_check: bool = True,
         arm=True,
+        result_cache: Optional[ResultCache] = None,
+        max_workers: Optional[int] = 1,
     ):
         """
         Note: `build_command` must be given for compilation to happen; there is not implicit build
         command.
+
+        `max_workers` is the number of test cases executed concurrently once the
+        missing files check and the build have passed. The default of 1 runs them
+        one after another; None picks a number based on the CPU count.
+
+        If `result_cache` is given, I/O tests reuse results from earlier runs of the
+        same command and input against identical sandbox contents.
         """
 
         self.name = name
@@ -54,6 +65,8 @@ class Autograder:
         self.supplied_files = supplied_files
         self.verbose_rubric = verbose_rubric
         self.compile_points = compile_points
+        self.result_cache = result_cache
+        self.max_workers = max_workers
 
         self.test_cases: List[TestCaseBase] = []
 
@@ -117,6 +130,14 @@ class Autograder:
         test_case.name = f"{self.name}: {test_case.name}"
         self.test_cases.append(test_case)
 
+    def add_tests(self, test_cases: List[TestCaseBase]):
+        """
+        Add several test cases of any kind to the autograder at once.
+        """
+        for test_case in test_cases:
+            test_case.name = f"{self.name}: {test_case.name}"
+        self.test_cases.extend(test_cases)
+
     def io_tests_bulk_loader(
         self,
         prefix: str = "",
@@ -131,6 +152,7 @@ class Autograder:
         test_input_prefix: Optional[str] = "in-",
         expected_stdout_prefix: Optional[str] = "out-",
         expected_stderr_prefix: Optional[str] = "err-",
+        batch_mode: bool = False,
     ) -> IOTestCaseBulkLoader:
         """
         Creates a bulk loader for I/O-based test cases to create tests
@@ -144,6 +166,9 @@ class Autograder:
         ```
 
         with the desired parameters for the bulk loader and the add methods.
+
+        With `batch_mode`, test cases that share a command are run by one
+        process that supports the IOTestBatch protocol.
         """
         return IOTestCaseBulkLoader(
             self,
@@ -165,6 +190,7 @@ class Autograder:
             prefix=prefix,
             default_timeout=default_timeout,
             binary_io=binary_io,
+            batch_mode=batch_mode,
         )
 
     def copy2sandbox(self, src_dir, item):
@@ -190,16 +216,25 @@ class Autograder:
         self.copy_submission_files()
         self.copy_supplied_files()
 
-        for test in self.test_cases:
+        # The missing files check and the build are added first, and every
+        # other test depends on them, so they run on their own beforehand.
+        tests = list(self.test_cases)
+        while tests and tests[0] in (
+            self.missing_files_check_test_case,
+            self.build_test_case,
+        ):
+            test = tests.pop(0)
             test.execute()
 
             if test == self.missing_files_check_test_case and not test.result.passed:
                 logger.info("Some files are missing. Aborting autograder.")
-                break
+                return
 
             if test == self.build_test_case and not test.result.passed:
                 logger.info("Failed to compile. Aborting autograder.")
-                break
+                return
+
+        run_suite(tests, self.max_workers)
 
     def execute(self):
         logger.debug(platform.uname())
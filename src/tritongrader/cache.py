@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import functools
+
+from tempfile import mkdtemp
+from typing import Optional
+
+from tritongrader.runner import CommandRunner
+
+logger = logging.getLogger("tritongrader.cache")
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_digest(path: str, size: int, mtime_ns: int) -> bytes:
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 16), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def file_digest(path: str) -> bytes:
+    """
+    Hashes a file's contents. The contents are only hashed again once its
+    size or modification time changes.
+    """
+    st = os.stat(path)
+    return _file_digest(path, st.st_size, st.st_mtime_ns)
+
+
+def directory_digest(path: str) -> bytes:
+    """
+    Hashes the names and contents of all files under a directory. A file's
+    contents are only hashed again once its size or modification time changes.
+    """
+    digest = hashlib.blake2b()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            st = os.stat(file_path)
+            digest.update(os.path.relpath(file_path, path).encode() + b"\0")
+            digest.update(_file_digest(file_path, st.st_size, st.st_mtime_ns))
+    return digest.digest()
+
+
+class ResultCache:
+    """
+    An on-disk cache of command results, so that grading an unchanged
+    submission against unchanged tests again does not re-run its commands.
+
+    Each entry is a directory named by its key that holds the captured
+    stdout, stderr, and a small JSON file with the exit status and running time.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "tritongrader")
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        - path: defaults to $TRITONGRADER_CACHE_DIR if set, else DEFAULT_PATH.
+        """
+        if path is None:
+            path = os.environ.get("TRITONGRADER_CACHE_DIR", ResultCache.DEFAULT_PATH)
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts: bytes) -> str:
+        digest = hashlib.blake2b()
+        for part in parts:
+            # Hash each part separately so that boundaries are unambiguous.
+            digest.update(hashlib.blake2b(part).digest())
+        return digest.hexdigest()
+
+    def load(self, key: str, runner: CommandRunner) -> bool:
+        """
+        Replays a cached result into the runner. Returns False on a miss.
+        """
+        entry = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entry, "result.json"), "r") as fp:
+                meta = json.load(fp)
+        except FileNotFoundError:
+            return False
+        runner.replay(
+            os.path.join(entry, "stdout"),
+            os.path.join(entry, "stderr"),
+            meta["exit_status"],
+            meta["running_time"],
+        )
+        return True
+
+    def store(self, key: str, runner: CommandRunner):
+        entry = os.path.join(self.path, key)
+        if os.path.exists(entry):
+            return
+        # Entries are written under a temporary name and renamed into place,
+        # so that concurrent readers never observe a partial entry.
+        tmpdir = mkdtemp(prefix=".tmp-", dir=self.path)
+        shutil.copyfile(runner.stdout_tf, os.path.join(tmpdir, "stdout"))
+        shutil.copyfile(runner.stderr_tf, os.path.join(tmpdir, "stderr"))
+        with open(os.path.join(tmpdir, "result.json"), "w") as fp:
+            json.dump(
+                {
+                    "exit_status": runner.exit_status,
+                    "running_time": runner.running_time,
+                },
+                fp,
+            )
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            # Another process stored the same entry first.
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        logger.debug("Stored result %s", key)
@@ -1,8 +1,10 @@
 import json
 import logging
-from typing import Dict, Callable, List, Union, Iterable
+import traceback
+from typing import Dict, Callable, List, Union, Iterable, Optional
 from difflib import HtmlDiff
 from tritongrader import Autograder
+from tritongrader.runner import CommandRunner
 
 from tritongrader.test_case import TestCaseBase
 from tritongrader.test_case import IOTestCase
@@ -64,6 +66,37 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
         self.html_diff: bool = html_diff
         self.results: dict = None
 
+    def actual_output(self, runner: CommandRunner, stream: str) -> str:
+        """
+        Returns a command's captured output as text, with at most
+        max_output_bytes of it shown.
+        """
+        path = runner.stdout_tf if stream == "stdout" else runner.stderr_tf
+        return self.to_text(
+            runner.read_output_excerpt(path, stream, self.max_output_bytes)
+        )
+
+    def expected_output(self, test: IOTestCase, stream: str) -> str:
+        """
+        Returns a test's expected output as text, cut down to at most
+        max_output_bytes the same way as actual_output().
+        """
+        path = test.exp_stdout_path if stream == "stdout" else test.exp_stderr_path
+        if not path:
+            return ""
+        try:
+            excerpt = test.runner.read_output_excerpt(
+                path, f"expected {stream}", self.max_output_bytes
+            )
+        except FileNotFoundError:
+            return ""
+        return self.to_text(excerpt)
+
+    def to_text(self, data: Union[str, bytes, None]) -> Optional[str]:
+        if isinstance(data, bytes):
+            return IOTestCase.bin2text(data)
+        return data
+
     def html_diff_make_table(
         self,
         fromtext: str,
@@ -81,15 +114,24 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
         )
 
     def generate_html_diff(self, test: IOTestCase):
+        expected_stdout = self.expected_output(test, "stdout")
+        expected_stderr = self.expected_output(test, "stderr")
+        if test.result.passed:
+            # The output matched byte for byte, so the captured output does
+            # not need to be read back and decoded.
+            actual_stdout, actual_stderr = expected_stdout, expected_stderr
+        else:
+            actual_stdout = self.actual_output(test.runner, "stdout")
+            actual_stderr = self.actual_output(test.runner, "stderr")
         stdout_diff = self.html_diff_make_table(
-            fromtext=test.actual_stdout or "",
-            totext=test.expected_stdout or "",
+            fromtext=actual_stdout,
+            totext=expected_stdout,
             fromdesc="Your stdout",
             todesc="Expected stdout",
         )
         stderr_diff = self.html_diff_make_table(
-            fromtext=test.actual_stderr or "",
-            totext=test.expected_stderr or "",
+            fromtext=actual_stderr,
+            totext=expected_stderr,
             fromdesc="Your stderr",
             todesc="Expected stderr",
         )
@@ -110,34 +152,44 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
         return html
 
     def basic_io_output(self, test: IOTestCase):
+        if test.result.error:
+            # TODO report to Observer
+            summary = [
+                "=== Unexpected autograder runtime error!  Please notify your instructors. ===",
+            ]
+            e = test.result.exception
+            if e is not None:
+                summary.append(
+                    "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                )
+            if test.runner and test.runner.stdout_tf:
+                summary.extend(
+                    [
+                        "=== stdout ===",
+                        self.actual_output(test.runner, "stdout"),
+                        "=== stderr ===",
+                        self.actual_output(test.runner, "stderr"),
+                    ]
+                )
+            return "\n".join(summary)
+
         if not test.result.has_run or not test.runner:
             return "This test was not run."
 
-        if test.result.error:
-            # TODO report to Observer
-            return "\n".join(
-                [
-                    "=== Unexpected autograder runtime error!  Please notify your instructors. ===",
-                    "=== stdout ===",
-                    test.actual_stdout,
-                    "=== stderr ===",
-                    test.actual_stderr,
-                ]
-            )
         if test.result.timed_out:
             return "\n".join(
                 [
                     f"Test case timed out with limit = {test.timeout}.",
                     "== stdout ==",
-                    test.actual_stdout,
+                    self.actual_output(test.runner, "stdout"),
                     "== stderr ==",
-                    test.actual_stderr,
+                    self.actual_output(test.runner, "stderr"),
                 ]
             )
 
         status_str = "PASSED" if test.result.passed else "FAILED"
         summary = []
-        summary.append(f"{status_str} in {test.runner.running_time:.2f} ms.")
+        summary.append(f"{status_str} in {test.runner.running_time * 1000:.2f} ms.")
 
         if self.verbose:
             summary.extend(["=== test command ===", test.command])
@@ -147,9 +199,9 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
             summary.extend(
                 [
                     "=== expected stdout ===",
-                    test.expected_stdout,
+                    self.to_text(test.expected_stdout),
                     "=== expected stderr ===",
-                    test.expected_stderr,
+                    self.to_text(test.expected_stderr),
                     "=== expected exit status ===",
                     str(test.exp_exit_status),
                 ]
@@ -158,9 +210,9 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
                 summary.extend(
                     [
                         "=== your stdout ===",
-                        test.actual_stdout,
+                        self.actual_output(test.runner, "stdout"),
                         "=== your stderr ===",
-                        test.actual_stderr,
+                        self.actual_output(test.runner, "stderr"),
                         "=== your exit status ===",
                         str(test.exit_status),
                     ]
@@ -169,13 +221,21 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
         return "\n".join(summary)
 
     def format_io_test(self, test: IOTestCase):
+        # Tests that never ran or failed to run have no output to diff; the
+        # plain summary reports them.
+        html = (
+            self.html_diff
+            and test.result.has_run
+            and not test.result.error
+            and test.runner is not None
+        )
         return {
             "output_format":
-                "html" if self.html_diff else "simple_format",
+                "html" if html else "simple_format",
             "output":
                 (
                     self.generate_html_diff(test)
-                    if self.html_diff else self.basic_io_output(test)
+                    if html else self.basic_io_output(test)
                 ),
         }
 
@@ -197,9 +257,9 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
             summary.extend(
                 [
                     "=== stdout ===",
-                    test.runner.stdout,
+                    self.actual_output(test.runner, "stdout"),
                     "=== stderr ===",
-                    test.runner.stderr,
+                    self.actual_output(test.runner, "stderr"),
                 ]
             )
         return {
@@ -236,17 +296,16 @@ class GradescopeResultsFormatter(ResultsFormatterBase):
 
     def execute(self):
         logger.info("Formatter running...")
+        # Scores are only tallied here, at export time.
+        score = 0 if self.hide_points else self.get_total_score()
         self.results = {
             "output": self.message,
             "visibility": self.visibility,
             "stdout_visibility": self.stdout_visibility,
-            "score": self.get_total_score(),
+            "score": score,
             "tests": [self.format_test(i) for i in self.test_cases],
         }
-
-        if self.hide_points:
-            self.results["score"] = 0
-        logger.info("Formatter execution completed.")
+        logger.info(f"Formatter execution completed. Total score: {score}")
         return self.results
 
     def export(self, path="/autograder/results/results.json"):
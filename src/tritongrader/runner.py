@@ -1,18 +1,101 @@
 import os
+import re
+import errno
+import shlex
+import select
+import shutil
+import signal
 import subprocess
 import time
 import logging
+import functools
+import threading
 
 from tempfile import NamedTemporaryFile
-from typing import TextIO, Optional, BinaryIO
+from typing import TextIO, Optional, BinaryIO, List, Tuple
 
 logger = logging.getLogger("tritongrader.runner")
 
+# Serializes multi-line console output when commands run in parallel.
+print_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def _split_command(command: str) -> Optional[Tuple[str, ...]]:
+    """
+    Splits a command into its arguments, or returns None if it needs a
+    shell. Cached, since a test's command is the same every time it runs.
+    """
+    if CommandRunner.SHELL_SYNTAX.search(command):
+        return None
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        # Unbalanced quotes; leave the error message to the shell.
+        return None
+    if not argv or "=" in argv[0]:
+        return None
+    return tuple(argv)
+
+
+@functools.lru_cache(maxsize=256)
+def _which_on_path(name: str, path: Optional[str]) -> Optional[str]:
+    """
+    Searches PATH for a command. Every test of an ARM autograder runs
+    qemu-arm-static, so the search is done once per name rather than once
+    per test; it is repeated if PATH changes.
+    """
+    return shutil.which(name, path=path)
+
+
+def wait_for_exit(process: subprocess.Popen, timeout: Optional[float]) -> int:
+    """
+    Waits for a process to exit and returns its exit code, raising
+    subprocess.TimeoutExpired if it is still running after timeout seconds.
+
+    Popen.wait polls with a growing sleep when given a timeout, which can
+    leave a short-lived test's exit unnoticed for several milliseconds. On
+    Linux, a pidfd becomes readable the moment the process exits, so the
+    wait is done by polling it instead where possible.
+    """
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # No pidfd support (non-Linux, or a kernel older than 5.3).
+        return process.wait(timeout=timeout)
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if not poller.poll(None if timeout is None else timeout * 1000):
+            raise subprocess.TimeoutExpired(process.args, timeout)
+    finally:
+        os.close(pidfd)
+    return process.wait()
+
 
 class CommandRunner:
     DEFAULT_TIMEOUT = 1.0
     QEMU_ARM = "qemu-arm-static -L /usr/arm-linux-gnueabihf/ "
 
+    # Emulated processes are memory-hungry, so cap how many can run at
+    # once when runners are executed in parallel.
+    MAX_CONCURRENT_ARM = 4
+    arm_slots = threading.BoundedSemaphore(MAX_CONCURRENT_ARM)
+
+    # Captured output beyond this size is most likely from a runaway loop,
+    # so only the beginning of it is read back.
+    MAX_OUTPUT_SIZE = 20000000
+    TRUNCATED_OUTPUT_SIZE = 4096
+
+    # Outputs are compared against expected files in blocks of this size,
+    # stopping at the first block that differs.
+    COMPARE_BLOCK_SIZE = 128 * 1024
+
+    # Anything outside of plain words, paths, spaces, and quotes needs a
+    # shell. Without $, `, or backslashes, quotes mean the same to shlex as
+    # they do to sh.
+    SHELL_SYNTAX = re.compile(r"""[^\w@%+=:,./\- '"]""")
+
     def __init__(
         self,
         command: str,
@@ -22,9 +105,11 @@ class CommandRunner:
         timeout: float = DEFAULT_TIMEOUT,
         text: bool = True,
         arm: bool = False,
+        stdin_path: Optional[str] = None,
     ):
         """
         - timeout: timeout in seconds.
+        - stdin_path: file to connect to the command's standard input.
         """
         if arm:
             self.command = CommandRunner.QEMU_ARM + command
@@ -36,10 +121,15 @@ class CommandRunner:
         self.print_output = print_output
         self.timeout = timeout
         self.text = text
+        self.read_mode: str = "r" if text else "rb"
+        self.write_mode: str = "w" if text else "wb"
         self.arm = arm
+        self.stdin_path: Optional[str] = stdin_path
         self.stdout_tf: Optional[str] = None
         self.stderr_tf: Optional[str] = None
-        self.running_time: float = 0
+        self.stdout_size: Optional[int] = None
+        self.stderr_size: Optional[int] = None
+        self.running_time: float = 0  # seconds
         self.exit_status = None
 
     def __del__(self):
@@ -48,6 +138,55 @@ class CommandRunner:
         if self.stderr_tf:
             os.remove(self.stderr_tf)
 
+    def _direct_argv(self) -> Optional[Tuple[str, List[str]]]:
+        """
+        Returns the resolved executable and argument vector if the command
+        can be started without going through /bin/sh, otherwise None.
+
+        Executing directly skips the intermediate shell process.
+        """
+        argv = _split_command(self.command)
+        if argv is None:
+            return None
+        argv = list(argv)
+        if "/" in argv[0]:
+            executable = shutil.which(argv[0])
+        else:
+            executable = _which_on_path(argv[0], os.environ.get("PATH"))
+        if executable is None:
+            # Could be a shell builtin; let the shell deal with it.
+            return None
+        return executable, argv
+
+    def _popen(
+        self,
+        direct: Optional[Tuple[str, List[str]]],
+        stdin: Optional[BinaryIO],
+        stdout: Optional[BinaryIO],
+        stderr: Optional[BinaryIO],
+    ) -> subprocess.Popen:
+        """
+        Starts the command, directly if direct is given, otherwise through
+        /bin/sh.
+        """
+        # The program under test, or the shell running it, may start children
+        # of its own, which killing it alone would leave running. Every command
+        # gets a session, and with it a process group to kill as a whole.
+        shell = direct is None
+        executable, args = direct if direct else (None, self.command)
+        return subprocess.Popen(
+            args,
+            executable=executable,
+            shell=shell,
+            # The program under test gets no descriptor of the grader's
+            # other than its standard streams.
+            close_fds=True,
+            start_new_session=True,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
+        )
+
     def print_text_file(self, fp: TextIO, heading=""):
         if heading:
             print(heading)
@@ -57,116 +196,196 @@ class CommandRunner:
                 break
             print(line, end="")
 
-    @property
-    def read_mode(self):
-        return "r" if self.text else "rb"
-
-    @property
-    def write_mode(self):
-        return "w" if self.text else "wb"
-
-    def compare(self, file_a: str, file_b: str) -> bool:
-        file_a_size = os.path.getsize(file_a)
-        file_b_size = os.path.getsize(file_b)
-        if file_a_size != file_b_size:
-            return False # skip checking contents if lengths differ
+    def compare(self, file_a: str, file_b: str, size_a: Optional[int] = None) -> bool:
+        """
+        - size_a: size of file_a, if already known.
+        """
+        if size_a is None:
+            size_a = os.path.getsize(file_a)
+        if size_a != os.path.getsize(file_b):
+            return False
+        if size_a == 0:
+            # Common for expected stderr; nothing to read.
+            return True
+        # Both files are read into the same two buffers block by block,
+        # rather than allocating a new bytes object for every block.
+        a_block = bytearray(CommandRunner.COMPARE_BLOCK_SIZE)
+        b_block = bytearray(CommandRunner.COMPARE_BLOCK_SIZE)
         with open(file_a, "rb") as a, open(file_b, "rb") as b:
-            if file_a_size <= 20000000:
-                # safe to check directly (hard coded upper bound)
-                return a.read() == b.read()
-            # else do chunked reads
-            BLOCK_SIZE = 8192
-            a_block = a.read(BLOCK_SIZE)
-            b_block = b.read(BLOCK_SIZE)
-            while a_block:
-                # can loop only on a_block b/c lengths are equal here
+            while True:
+                a_len = a.readinto(a_block)
+                b_len = b.readinto(b_block)
+                if a_len != b_len:
+                    return False
+                if a_len < CommandRunner.COMPARE_BLOCK_SIZE:
+                    return a_block[:a_len] == b_block[:b_len]
                 if a_block != b_block:
                     return False
-                a_block = a.read(BLOCK_SIZE)
-                b_block = b.read(BLOCK_SIZE)
-        return True
 
     def check_stdout(self, expected_stdout: str) -> bool:
         assert self.stdout_tf is not None
-        return self.compare(self.stdout_tf, expected_stdout)
+        return self.compare(self.stdout_tf, expected_stdout, self.stdout_size)
 
     def check_stderr(self, expected_stderr: str) -> bool:
         assert self.stderr_tf is not None
-        return self.compare(self.stderr_tf, expected_stderr)
+        return self.compare(self.stderr_tf, expected_stderr, self.stderr_size)
 
-    @property
-    def stdout(self):
+    def read_output(self, path: str, stream: str):
         if not self.capture_output:
-            raise Exception("stdout was not captured")
-        with open(self.stdout_tf, self.read_mode) as fp:
+            raise Exception(f"{stream} was not captured")
+        with open(path, self.read_mode) as fp:
             try:
-                if os.path.getsize(
-                    self.stdout_tf
-                ) > 20000000:  #hard coded big number, maybe parametrize this
-                    msg = "stdout is too large to read, you may have an infinite loop in your code. " \
-                           "Here are the first 4096 bytes of stdout:\n"
-                    pos = 0
-                    while (pos < 4096):
-                        msg += fp.readline(4096 - pos)
-                        pos = fp.tell()
-                    fp.close()
-                    return msg
-                else:
-                    msg = fp.read()
-                    fp.close()
-                    return msg
+                if os.fstat(fp.fileno()).st_size <= CommandRunner.MAX_OUTPUT_SIZE:
+                    return fp.read()
+                head = fp.read(CommandRunner.TRUNCATED_OUTPUT_SIZE)
             except UnicodeDecodeError as e:
-                return f"tritongrader: error decoding stdout as UTF-8: {e}"
+                return f"tritongrader: error decoding {stream} as UTF-8: {e}"
+        msg = (
+            f"{stream} is too large to read, you may have an infinite loop in your code. "
+            f"Here are the first {CommandRunner.TRUNCATED_OUTPUT_SIZE} bytes of {stream}:\n"
+        )
+        return msg + head if self.text else msg.encode() + head
+
+    def read_output_excerpt(self, path: str, stream: str, limit: int):
+        """
+        Reads captured output for display. Output larger than limit bytes is
+        cut down to its first and last limit // 2 bytes, and the middle is
+        never read.
+        """
+        if not self.capture_output:
+            raise Exception(f"{stream} was not captured")
+        with open(path, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size <= limit:
+                return self.read_output(path, stream)
+            half = limit // 2
+            head = fp.read(half)
+            fp.seek(size - half)
+            tail = fp.read()
+        excerpt = b"".join(
+            [head, f"\n...[truncated {size - 2 * half} bytes]...\n".encode(), tail]
+        )
+        return excerpt.decode("utf-8", "replace") if self.text else excerpt
+
+    @property
+    def stdout(self):
+        return self.read_output(self.stdout_tf, "stdout")
 
     @property
     def stderr(self):
-        if not self.capture_output:
-            raise Exception("stderr was not captured")
-        with open(self.stderr_tf, self.read_mode) as fp:
-            try:
-                if os.path.getsize(
-                    self.stderr_tf
-                ) > 20000000:  #hard coded big number, maybe parametrize this
-                    msg = "stderr is too large to read, you may have an infinite loop in your code. " \
-                           "Here are the first 4096 bytes of stderr:\n"
-                    pos = 0
-                    while (pos < 4096):
-                        msg += fp.readline(4096 - pos)
-                        pos = fp.tell()
-                    fp.close()
-                    return msg
-                else:
-                    msg = fp.read()
-                    fp.close()
-                    return msg
-            except UnicodeDecodeError as e:
-                return f"tritongrader: error decoding stderr as UTF-8: {e}"
+        return self.read_output(self.stderr_tf, "stderr")
+
+    @staticmethod
+    def _capture_file() -> BinaryIO:
+        """
+        Creates a file to capture output to, in $TRITONGRADER_CAPTURE_DIR if
+        set, otherwise in the system temporary directory. Pointing it at a
+        tmpfs such as /dev/shm keeps captures off the disk.
+        """
+        return NamedTemporaryFile(
+            "wb", delete=False, dir=os.environ.get("TRITONGRADER_CAPTURE_DIR")
+        )
+
+    def _copy_to_tempfile(self, path: str) -> str:
+        with open(path, "rb") as src, CommandRunner._capture_file() as dst:
+            shutil.copyfileobj(src, dst)
+        return dst.name
+
+    def _write_to_tempfile(self, data: bytes) -> str:
+        with CommandRunner._capture_file() as dst:
+            dst.write(data)
+        return dst.name
+
+    def record(
+        self,
+        stdout: bytes,
+        stderr: bytes,
+        exit_status: Optional[int],
+        running_time: float,
+    ):
+        """
+        Sets the output of a run made elsewhere instead of executing the command.
+        """
+        self.stdout_tf = self._write_to_tempfile(stdout)
+        self.stderr_tf = self._write_to_tempfile(stderr)
+        self.stdout_size = len(stdout)
+        self.stderr_size = len(stderr)
+        self.exit_status = exit_status
+        self.running_time = running_time
+
+    def replay(
+        self,
+        stdout_path: str,
+        stderr_path: str,
+        exit_status: int,
+        running_time: float,
+    ):
+        """
+        Restores a previously recorded run instead of executing the command.
+        """
+        self.stdout_tf = self._copy_to_tempfile(stdout_path)
+        self.stderr_tf = self._copy_to_tempfile(stderr_path)
+        self.stdout_size = os.path.getsize(self.stdout_tf)
+        self.stderr_size = os.path.getsize(self.stderr_tf)
+        self.exit_status = exit_status
+        self.running_time = running_time
 
     def run(self):
+        infp = outfp = errfp = None
         if self.capture_output:
-            self.stdout_tf = NamedTemporaryFile(
-                "w+" if self.text else "w+b", delete=False
-            ).name
-            self.stderr_tf = NamedTemporaryFile(
-                "w+" if self.text else "w+b", delete=False
-            ).name
-            outfp = open(self.stdout_tf, self.write_mode)
-            errfp = open(self.stderr_tf, self.write_mode)
+            # The child writes straight to these descriptors, so the mode
+            # only matters for reading the output back.
+            outfp = CommandRunner._capture_file()
+            errfp = CommandRunner._capture_file()
+            self.stdout_tf = outfp.name
+            self.stderr_tf = errfp.name
 
         if self.print_command:
-            print(f"Current working directory: {os.getcwd()}")
-            print(f"Files: {[f for f in os.listdir('.')]}")
-            print(f"$ {self.command}")
-
-        start_ts = time.time()
-        sp = subprocess.run(
-            self.command,
-            shell=True,
-            stdout=outfp if self.capture_output else None,
-            stderr=errfp if self.capture_output else None,
-            text=self.text,
-            timeout=self.timeout,
-        )
-        end_ts = time.time()
-        self.running_time = end_ts - start_ts
-        self.exit_status: int = sp.returncode
+            redirect = f" < {self.stdin_path}" if self.stdin_path else ""
+            with print_lock:
+                print(f"Current working directory: {os.getcwd()}")
+                print(f"Files: {[f for f in os.listdir('.')]}")
+                print(f"$ {self.command}{redirect}")
+
+        if self.arm:
+            CommandRunner.arm_slots.acquire()
+        try:
+            if self.stdin_path:
+                infp = open(self.stdin_path, "rb")
+            direct = self._direct_argv()
+            start_ns = time.perf_counter_ns()
+            try:
+                process = self._popen(direct, infp, outfp, errfp)
+            except OSError as e:
+                if direct is None or e.errno != errno.ENOEXEC:
+                    raise
+                # A script without a #! line, which only a shell will run.
+                direct = None
+                process = self._popen(direct, infp, outfp, errfp)
+            with process:
+                try:
+                    returncode = wait_for_exit(process, self.timeout)
+                except BaseException:
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    process.wait()
+                    raise
+            end_ns = time.perf_counter_ns()
+            if self.capture_output:
+                self.stdout_size = os.fstat(outfp.fileno()).st_size
+                self.stderr_size = os.fstat(errfp.fileno()).st_size
+        finally:
+            if self.arm:
+                CommandRunner.arm_slots.release()
+            if infp:
+                infp.close()
+            if outfp:
+                outfp.close()
+            if errfp:
+                errfp.close()
+        self.running_time = (end_ns - start_ns) / 1e9
+        # Report death by signal N as 128 + N, the way a shell does, so that exit
+        # statuses do not depend on whether the command ran through a shell.
+        self.exit_status: int = returncode if returncode >= 0 else 128 - returncode
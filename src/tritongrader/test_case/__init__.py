@@ -1,4 +1,4 @@
 from .custom_test_case import CustomTestCase, CustomTestResult  # noqa
-from .io_test_case import IOTestCase, IOTestResult, IOTestCaseBulkLoader  # noqa
-from .test_case_base import TestCaseBase, TestResultBase  # noqa
+from .io_test_case import IOTestCase, IOTestResult, IOTestBatch, IOTestCaseBulkLoader, prefetch_expected  # noqa
+from .test_case_base import TestCaseBase, TestResultBase, run_suite  # noqa
 from .basic_test_case import BasicTestCase, BasicTestResult  # noqa
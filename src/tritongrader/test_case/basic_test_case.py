@@ -1,6 +1,5 @@
 import logging
 import subprocess
-import traceback
 
 from tritongrader.test_case.test_case_base import TestCaseBase, TestResultBase
 from tritongrader.runner import CommandRunner
@@ -9,6 +8,8 @@ logger = logging.getLogger("tritongrader.test_case.basic_test_case")
 
 
 class BasicTestResult(TestResultBase):
+    __slots__ = ("retcode", "stderr", "stdout")
+
     def __init__(self):
         super().__init__()
         self.retcode: int = None
@@ -52,7 +53,9 @@ class BasicTestCase(TestCaseBase):
             arm=self.arm,
         )
         self.runner.run()
-        self.result.passed = self.runner.exit_status == self.expected_retcode
+        self.result.retcode = self.runner.exit_status
+        self.result.running_time = self.runner.running_time
+        self.result.passed = self.result.retcode == self.expected_retcode
         self.result.score = self.point_value if self.result.passed else 0
 
     def execute(self):
@@ -61,5 +64,5 @@ class BasicTestCase(TestCaseBase):
         try:
             self._execute()
         except subprocess.TimeoutExpired:
-            logger.info(f"{self.name} timed out (limit={self.timeout}s)!")
+            logger.info("%s timed out (limit=%ss)!", self.name, self.timeout)
             self.result.timed_out = True
@@ -1,17 +1,57 @@
+import os
+import time
+import signal
 import logging
+import threading
+import contextlib
 
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from typing import Callable
 
 from tritongrader.test_case.test_case_base import TestCaseBase, TestResultBase
 
 logger = logging.getLogger("tritongrader.test_case")
 
+# Shared by all custom test cases so that a thread is not set up per test.
+_custom_pool = ThreadPoolExecutor(max_workers=max(4, os.cpu_count() or 1))
 
-class CustomTestResult(TestResultBase):
+
+class _Timeout(BaseException):
+    # Not an Exception, so that `except Exception` in a test function does
+    # not swallow it, just like KeyboardInterrupt.
     pass
 
 
+@contextlib.contextmanager
+def _alarm(timeout: float):
+    """
+    Raises _Timeout in the main thread if the block runs longer than timeout
+    seconds.
+    """
+
+    def on_alarm(signum, frame):
+        raise _Timeout()
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class CustomTestResult(TestResultBase):
+    # No __slots__ here: test functions may attach fields of their own.
+    def __init__(self):
+        super().__init__()
+        self.output: str = ""
+
+
 class CustomTestCase(TestCaseBase):
+    # Only on the main thread can the function be interrupted by SIGALRM.
+    EXECUTE_ON_CALLER = True
+
     def __init__(
         self,
         func: Callable[[CustomTestResult], None],
@@ -20,10 +60,52 @@ class CustomTestCase(TestCaseBase):
         timeout: float = TestCaseBase.DEFAULT_TIMEOUT,
         hidden: bool = False,
     ):
+        """
+        - timeout: timeout in seconds. On the main thread, the function is
+          interrupted by SIGALRM when it times out. Elsewhere it runs on a
+          shared pool of worker threads, which cannot be killed. There, the
+          function gets a result of its own, which is only kept if it returns
+          in time, and whose `timed_out` is set when the limit is reached. A
+          function that may run long should check it as a stop flag and
+          return; one that does not keeps its worker busy, and the
+          interpreter waits for it at exit.
+        """
         super().__init__(name, point_value, timeout, hidden)
         self.test_func: Callable[[CustomTestResult], None] = func
         self.result: CustomTestResult = CustomTestResult()
 
     def execute(self):
         self.result.has_run = True
-        self.test_func(self.result)
+        start_ns = time.perf_counter_ns()
+        try:
+            self._execute()
+        finally:
+            self.result.running_time = (time.perf_counter_ns() - start_ns) / 1e9
+
+    def _execute(self):
+        # Signal handlers can only be installed on the main thread.
+        if threading.current_thread() is threading.main_thread():
+            try:
+                with _alarm(self.timeout):
+                    self.test_func(self.result)
+            except _Timeout:
+                self._on_timeout()
+            return
+
+        result = CustomTestResult()
+        result.has_run = True
+        future = _custom_pool.submit(self.test_func, result)
+        try:
+            future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            # The function may still be running; this is its stop flag.
+            result.timed_out = True
+            self._on_timeout()
+            return
+        self.result = result
+
+    def _on_timeout(self):
+        logger.info("%s timed out (limit=%ss)!", self.name, self.timeout)
+        self.result.timed_out = True
+        self.result.passed = False
+        self.result.score = 0
@@ -1,20 +1,93 @@
 import os
-import traceback
+import time
+import select
+import signal
+import struct
+import functools
 import logging
+import threading
+import traceback
 import subprocess
 
-from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from tritongrader.test_case.test_case_base import TestCaseBase, TestResultBase
-from tritongrader.runner import CommandRunner
+from tritongrader.runner import CommandRunner, print_lock, _split_command
+from tritongrader.cache import ResultCache, directory_digest, file_digest
 
 logger = logging.getLogger("tritongrader.test_case.io_test_case")
 
 
+def _fast_read_bytes(path: str) -> bytes:
+    """
+    Reads a whole file with one read() sized by fstat(), skipping the extra
+    ioctl/lseek/fstat calls that a buffered open().read() goes through.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        return os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_file(path: str, binary: bool, mtime_ns: int) -> Union[str, bytes]:
+    data = _fast_read_bytes(path)
+    if binary:
+        return data
+    text = data.decode()
+    if "\r" in text:
+        # Same universal newline translation as open() in text mode.
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_command(path: str, mtime_ns: int) -> Tuple[str, bool]:
+    """
+    Returns the command on the second line of a command file, and whether the
+    file is just a shell shebang followed by that command (blank lines aside)
+    and the command needs no shell, so it can be run in place of the file.
+    The command is empty if the file has no second line.
+
+    Being cached, test cases that share a command file also share one command
+    string instead of each holding a copy.
+    """
+    with open(path, "r") as fp:
+        shebang = fp.readline()
+        command = fp.readline()
+        if not command:
+            return "", False
+        # Stops reading at the first non-blank line after the command.
+        whole_script = not any(line.strip() for line in fp)
+    # Only a bare sh or bash; flags such as -x change what the script does.
+    interpreter = [os.path.basename(word) for word in shebang[2:].split()]
+    whole_script = whole_script and shebang.startswith("#!") and (
+        interpreter in (["sh"], ["bash"], ["env", "sh"], ["env", "bash"])
+    )
+    # Shell syntax would be run by /bin/sh rather than the script's own
+    # interpreter, and $0 and $@ would mean something else.
+    whole_script = whole_script and _split_command(command.rstrip("\n")) is not None
+    return command.rstrip("\n"), whole_script
+
+
+def _read_file_cached(path: str, binary: bool = False) -> Union[str, bytes]:
+    """
+    Reads a test fixture file. Contents are shared across test cases and
+    reused until the file's modification time changes.
+    """
+    return _read_file(path, binary, os.stat(path).st_mtime_ns)
+
+
 class IOTestResult(TestResultBase):
+    __slots__ = ("exit_status", "exception", "stderr", "stdout")
+
     def __init__(self):
         super().__init__()
         self.exit_status: Optional[int] = None
+        # Set along with `error`; its traceback is only formatted for display.
+        self.exception: Optional[Exception] = None
         self.stderr: str = ""
         self.stdout: str = ""
 
@@ -33,9 +106,15 @@ class IOTestCase(TestCaseBase):
         arm: bool = True,
         binary_io: bool = False,
         hidden: bool = False,
+        input_exists: Optional[bool] = None,
+        result_cache: Optional[ResultCache] = None,
     ):
         """
         - timeout: timeout in seconds.
+        - input_exists: whether input_path exists, if already known; saves a
+          stat() per test case when loading in bulk.
+        - result_cache: if given, results of previous runs of the same command
+          and input against identical sandbox contents are reused.
         """
         super().__init__(name, point_value, timeout, hidden)
 
@@ -44,19 +123,33 @@ class IOTestCase(TestCaseBase):
 
         self.command_path: str = command_path
         self.command: str = ""
+        # Parsed once here; a command file that cannot be read yet is read
+        # again at execution time, where the error is reported.
+        self.whole_script: Optional[bool] = None
+        try:
+            self.command, self.whole_script = _read_command(
+                command_path, os.stat(command_path).st_mtime_ns
+            )
+        except (OSError, ValueError):
+            pass
 
-        self.input_path: str = input_path if os.path.exists(input_path) else None
+        if input_exists is None:
+            input_exists = os.path.exists(input_path)
+        self.input_path: Optional[str] = input_path if input_exists else None
         self.exp_stdout_path: str = exp_stdout_path
         self.exp_stderr_path: str = exp_stderr_path
         self.exp_exit_status: Optional[int] = exp_exit_status
 
+        self.result_cache: Optional[ResultCache] = result_cache
+        # Set by IOTestBatch.add().
+        self.batch: Optional[IOTestBatch] = None
+
         self.result: IOTestResult = IOTestResult()
         self.runner: CommandRunner = None
 
     def __str__(self):
         return (
             f"{self.name} arm={self.arm} cmd_path={self.command_path} cmd={self.command} "
-            +
             f"input_path={self.input_path} exp_stdout_path={self.exp_stdout_path} exp_stderr_path={self.exp_stderr_path}"
         )
 
@@ -64,19 +157,23 @@ class IOTestCase(TestCaseBase):
     def open_mode(self):
         return "r" if not self.binary_io else "rb"
 
+    def _read_expected(self, path: str):
+        try:
+            return _read_file_cached(path, self.binary_io)
+        except FileNotFoundError:
+            return b"" if self.binary_io else ""
+
     @property
     def expected_stdout(self):
         if not self.exp_stdout_path:
             return None
-        with open(self.exp_stdout_path, self.open_mode) as fp:
-            return fp.read()
+        return self._read_expected(self.exp_stdout_path)
 
     @property
     def expected_stderr(self):
         if not self.exp_stderr_path:
             return None
-        with open(self.exp_stderr_path, self.open_mode) as fp:
-            return fp.read()
+        return self._read_expected(self.exp_stderr_path)
 
     @property
     def actual_stdout(self) -> str:
@@ -90,11 +187,24 @@ class IOTestCase(TestCaseBase):
             raise Exception("no runner initialized")
         return self.runner.stderr
 
+    @staticmethod
+    def bin2text(binary: bytes) -> str:
+        """
+        Decodes binary I/O for display, falling back to a hex dump if it
+        is not valid UTF-8.
+        """
+        if binary.isascii():
+            # Most output is ASCII, which decodes without UTF-8 validation.
+            return binary.decode("ascii")
+        text = binary.decode("utf-8", "replace")
+        if "\ufffd" not in text:
+            return text
+        # Two bytes per group; bytes.hex() only takes a separator from 3.8 on.
+        digits = binary.hex()
+        return " ".join(digits[i : i + 4] for i in range(0, len(digits), 4))
+
     def extract_command_from_bash_file(self, bash_file_path):
-        # Command files cannot be binary. Can use "r" mode directly here.
-        with open(bash_file_path, "r") as cmd_fp:
-            test_command = cmd_fp.read().split("\n")[1]
-        return test_command
+        return _read_command(bash_file_path, os.stat(bash_file_path).st_mtime_ns)[0]
 
     @property
     def test_input(self):
@@ -103,22 +213,63 @@ class IOTestCase(TestCaseBase):
 
         # test input is passed in via command line ('<'), which
         # should always be text, so we don't use open_mode() here.
-        with open(self.input_path, "r") as fp:
-            return fp.read()
+        return _read_file_cached(self.input_path)
 
     def get_execute_command(self):
-        self.command = self.extract_command_from_bash_file(self.command_path)
-        logger.info(f"Running {str(self)}")
+        command = self._execute_command()
+        logger.info("Running %s", self)
+        return command
+
+    def _execute_command(self) -> str:
+        if self.whole_script is None:
+            self.command, self.whole_script = _read_command(
+                self.command_path, os.stat(self.command_path).st_mtime_ns
+            )
         # if running in an ARM simulator, we cannot use the bash script
-        # and must instead use the command inside directly.
-        exe = self.command if self.arm else self.command_path
-        if self.input_path:
-            exe += f" < {self.input_path}"
-        return exe
+        # and must instead use the command inside directly. The same is done
+        # natively when that command is all the script does, which saves
+        # starting a bash interpreter for every test.
+        # Test input is connected to the runner's stdin rather than through a
+        # shell redirection, so the command can be spawned without a shell.
+        return self.command if self.arm or self.whole_script else self.command_path
+
+    def _output_matches(self, output_path: str, output_size: int, expected_path: str) -> bool:
+        """
+        Compares captured output against an expected output file. Small
+        expected files are read once and kept in memory, so repeated checks
+        against them only read the captured output. Empty output is expected
+        if the file is empty or missing; neither is read.
+        """
+        try:
+            st = os.stat(expected_path)
+        except FileNotFoundError:
+            # Most tests expect no stderr, so its file is often left out.
+            return output_size == 0
+        if st.st_size != output_size:
+            return False
+        if output_size == 0:
+            return True
+        if output_size > CommandRunner.COMPARE_BLOCK_SIZE:
+            return self.runner.compare(output_path, expected_path, output_size)
+        return _fast_read_bytes(output_path) == _read_file(
+            expected_path, True, st.st_mtime_ns
+        )
+
+    def result_cache_key(self) -> str:
+        # The sandbox (the working directory at execution time) holds the
+        # submission and anything built from it.
+        return ResultCache.make_key(
+            self.runner.command.encode(),
+            file_digest(self.command_path),
+            file_digest(self.input_path) if self.input_path else b"",
+            str(self.timeout).encode(),
+            directory_digest(os.getcwd()),
+        )
 
     def execute(self):
         # reset states
         self.result = IOTestResult()
+        self.runner = None
 
         # run test case
         self.result.has_run = True
@@ -130,29 +281,193 @@ class IOTestCase(TestCaseBase):
                 timeout=self.timeout,
                 print_command=True,
                 arm=self.arm,
+                stdin_path=self.input_path,
+            )
+            cache_key = None
+            if self.result_cache and not self.batch:
+                cache_key = self.result_cache_key()
+            if self.batch:
+                self.batch.replay(self, self.runner)
+            elif cache_key and self.result_cache.load(cache_key, self.runner):
+                logger.info("%s: reusing cached result", self.name)
+            else:
+                self.runner.run()
+                if cache_key:
+                    self.result_cache.store(cache_key, self.runner)
+
+            stdout_check = self._output_matches(
+                self.runner.stdout_tf, self.runner.stdout_size, self.exp_stdout_path
+            )
+            stderr_check = self._output_matches(
+                self.runner.stderr_tf, self.runner.stderr_size, self.exp_stderr_path
             )
-            self.runner.run()
-
-            stdout_check = self.runner.check_stdout(self.exp_stdout_path)
-            stderr_check = self.runner.check_stderr(self.exp_stderr_path)
             status = True
             if self.exp_exit_status is not None:
                 status = self.exp_exit_status == self.runner.exit_status
-            # TODO self.result.exit_status
+            self.result.exit_status = self.runner.exit_status
+            self.result.running_time = self.runner.running_time
             self.exit_status: int = self.runner.exit_status
             self.result.passed = stdout_check and stderr_check and status
             self.result.score = self.point_value if self.result.passed else 0
 
             # TODO report to students
-            print(
-                f"stdout check: {stdout_check}; stderr check: {stderr_check}; status: {status}"
-            )
+            with print_lock:
+                print(
+                    f"stdout check: {stdout_check}; stderr check: {stderr_check}; status: {status}"
+                )
         except subprocess.TimeoutExpired:
-            logger.info(f"{self.name} timed out (limit={self.timeout}s)!")
+            logger.info("%s timed out (limit=%ss)!", self.name, self.timeout)
             self.result.timed_out = True
+        except Exception as e:
+            logger.info("%s failed to run: %r", self.name, e)
+            # Keeps line numbers for the traceback, but not every frame's locals.
+            traceback.clear_frames(e.__traceback__)
+            self.result.error = True
+            self.result.exception = e
+
+
+class IOTestBatch:
+    """
+    Runs the command shared by several IO test cases as one process, so that
+    its startup cost is paid once rather than once per test. Only for
+    programs written to support it: for each test, the program reads a frame
+    holding the test's input from stdin and writes a frame holding its output
+    to stdout. A frame is a 4-byte big-endian length followed by that many
+    bytes. The process is killed once every test has been answered.
+
+    Only stdout is checked; an answered test is recorded with empty stderr
+    and an exit status of 0. A test that is not answered within its timeout
+    times out, and one that is not answered otherwise (e.g. the program
+    exits) fails with an error. The tests after it run in a new process.
+    """
+
+    FRAME_HEADER = struct.Struct(">I")
+
+    def __init__(self, command: str, arm: bool = False):
+        self.command: str = CommandRunner.QEMU_ARM + command if arm else command
+        self.arm: bool = arm
+        self.test_cases: List[IOTestCase] = []
+        # Output, running time, and error of each test case not yet replayed.
+        self.outcomes: Dict[
+            IOTestCase, Tuple[bytes, float, Optional[Exception]]
+        ] = {}
+        self.lock = threading.Lock()
+
+    def add(self, test_case: IOTestCase) -> "IOTestBatch":
+        test_case.batch = self
+        self.test_cases.append(test_case)
+        return self
+
+    def replay(self, test_case: IOTestCase, runner: CommandRunner):
+        """
+        Records a test case's outcome into its runner, running the batch
+        first if it has not been run since the test case was last replayed.
+        Raises the error the test case failed with, if any.
+        """
+        with self.lock:
+            if test_case not in self.outcomes:
+                self.outcomes = self._run()
+            output, running_time, error = self.outcomes.pop(test_case)
+        runner.record(output, b"", None if error else 0, running_time)
+        if error:
+            raise error
+
+    def _run(self) -> Dict[IOTestCase, Tuple[bytes, float, Optional[Exception]]]:
+        outcomes = {}
+        pending = list(self.test_cases)
+        while pending:
+            self._run_process(pending, outcomes)
+        return outcomes
+
+    def _run_process(self, pending: List[IOTestCase], outcomes: dict):
+        """
+        Answers test cases from the front of pending with one process, until
+        they run out or one of them fails.
+        """
+        logger.info("Running a batch of %d tests: %s", len(pending), self.command)
+        if self.arm:
+            CommandRunner.arm_slots.acquire()
+        try:
+            with subprocess.Popen(
+                self.command,
+                shell=True,
+                bufsize=0,
+                start_new_session=True,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ) as process:
+                try:
+                    os.set_blocking(process.stdin.fileno(), False)
+                    while pending:
+                        test_case = pending.pop(0)
+                        outcomes[test_case] = self._answer(process, test_case)
+                        if outcomes[test_case][2]:
+                            return
+                finally:
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+        finally:
+            if self.arm:
+                CommandRunner.arm_slots.release()
+
+    def _answer(
+        self, process: subprocess.Popen, test_case: IOTestCase
+    ) -> Tuple[bytes, float, Optional[Exception]]:
+        data = _fast_read_bytes(test_case.input_path) if test_case.input_path else b""
+        frame = IOTestBatch.FRAME_HEADER.pack(len(data)) + data
+        reply = bytearray()
+        error = None
+        start_ns = time.perf_counter_ns()
+        try:
+            self._exchange(process, frame, test_case.timeout, reply)
+        except (EOFError, OSError, ValueError, subprocess.TimeoutExpired) as e:
+            error = e
+        running_time = (time.perf_counter_ns() - start_ns) / 1e9
+        return bytes(reply[IOTestBatch.FRAME_HEADER.size :]), running_time, error
+
+    def _exchange(
+        self,
+        process: subprocess.Popen,
+        frame: bytes,
+        timeout: float,
+        reply: bytearray,
+    ):
+        """
+        Writes a frame to the process and reads the frame it answers with
+        into reply, writing and reading at the same time so that neither
+        side blocks on a full pipe.
+        """
+        stdin, stdout = process.stdin.fileno(), process.stdout.fileno()
+        header = IOTestBatch.FRAME_HEADER
+        unsent = memoryview(frame)
+        deadline = time.monotonic() + timeout
+        size = None
+        while size is None or len(reply) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.command, timeout)
+            readable, writable, _ = select.select(
+                [stdout], [stdin] if unsent else [], [], remaining
+            )
+            if writable:
+                unsent = unsent[os.write(stdin, unsent) :]
+            if readable:
+                block = os.read(stdout, CommandRunner.COMPARE_BLOCK_SIZE)
+                if not block:
+                    raise EOFError(f"{self.command} exited without answering")
+                reply += block
+                if size is None and len(reply) >= header.size:
+                    size = header.size + header.unpack_from(reply)[0]
+        if len(reply) > size:
+            raise ValueError(f"{self.command} wrote more than one frame")
 
 
 class IOTestCaseBulkLoader:
+    PREFETCH_WORKERS = 16
+
     def __init__(
         self,
         autograder,
@@ -169,9 +484,12 @@ class IOTestCaseBulkLoader:
         prefix: str = "",
         default_timeout: float = 500,
         binary_io: bool = False,
+        batch_mode: bool = False,
     ):
         """
         - default_timeout: timeout in seconds.
+        - batch_mode: run the test cases that share a command as an
+          IOTestBatch. The program must support the batch protocol.
         """
         self.autograder = autograder
         self.commands_path = commands_path
@@ -187,6 +505,31 @@ class IOTestCaseBulkLoader:
         self.prefix = prefix
         self.default_timeout = default_timeout
         self.binary_io = binary_io
+        self.batch_mode = batch_mode
+
+        self.test_cases: List[IOTestCase] = []
+        # One batch per command, in batch mode.
+        self.batches: Dict[str, IOTestBatch] = {}
+
+        # One directory listing instead of a stat() per test case.
+        self.test_input_names = self.list_files(test_input_path)
+        self.expected_exit_status_names = self.list_files(expected_exit_status_path)
+
+    @staticmethod
+    def list_files(path: Optional[str]) -> Set[str]:
+        """
+        Returns the names of the regular files in a directory, or an empty set
+        if the directory does not exist.
+        """
+        if path is None:
+            return set()
+        try:
+            with os.scandir(path) as it:
+                # is_file() is answered from the directory entry itself on
+                # most filesystems, without a stat() per file.
+                return {entry.name for entry in it if entry.is_file()}
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
 
     def add(
         self,
@@ -200,7 +543,28 @@ class IOTestCaseBulkLoader:
     ) -> "IOTestCaseBulkLoader":
         """
         - timeout: timeout in seconds.
+
+        Test cases without an expected exit status file do not check the exit
+        status.
         """
+        test_case = self._create(
+            name, point_value, hidden, timeout, binary_io, prefix, no_prefix
+        )
+        self.autograder.add_test(test_case)
+        self.test_cases.append(test_case)
+
+        return self
+
+    def _create(
+        self,
+        name: str,
+        point_value: float,
+        hidden: bool,
+        timeout: Optional[float],
+        binary_io: bool,
+        prefix: str,
+        no_prefix: bool = False,
+    ) -> IOTestCase:
         if timeout is None:
             timeout = self.default_timeout
 
@@ -212,14 +576,16 @@ class IOTestCaseBulkLoader:
         stderr = os.path.join(
             self.expected_stderr_path, self.expected_stderr_prefix + name
         )
-        if self.expected_exit_status_path is not None and self.expected_exit_status_prefix is not None:
+        exit_status = None
+        if (
+            self.expected_exit_status_prefix is not None
+            and self.expected_exit_status_prefix + name in self.expected_exit_status_names
+        ):
             file = os.path.join(
                 self.expected_exit_status_path, self.expected_exit_status_prefix + name
             )
             with open(file, "r") as fin:
                 exit_status = int(fin.read().strip())
-        else:
-            exit_status = None
 
         test_name = name if no_prefix else self.prefix + prefix + name
         test_case = IOTestCase(
@@ -234,11 +600,15 @@ class IOTestCaseBulkLoader:
             binary_io=binary_io,
             hidden=hidden,
             arm=self.autograder.arm,
+            input_exists=(self.test_input_prefix + name) in self.test_input_names,
+            result_cache=self.autograder.result_cache,
         )
-
-        self.autograder.add_test(test_case)
-
-        return self
+        if self.batch_mode:
+            command = test_case._execute_command()
+            if command not in self.batches:
+                self.batches[command] = IOTestBatch(command, self.autograder.arm)
+            self.batches[command].add(test_case)
+        return test_case
 
     def add_list(
         self,
@@ -248,7 +618,68 @@ class IOTestCaseBulkLoader:
         timeout: float = None,
         binary_io: bool = False,
     ):
-        for name, point_value in test_list:
-            self.add(name, point_value, hidden, timeout, binary_io, prefix=prefix)
-
+        test_cases = [
+            self._create(name, point_value, hidden, timeout, binary_io, prefix)
+            for name, point_value in test_list
+        ]
+        self.autograder.add_tests(test_cases)
+        self.test_cases.extend(test_cases)
+
+        # Load the fixtures of the whole list up front, so that slow storage
+        # is waited on concurrently instead of once per test during grading.
+        prefetch_expected(test_cases, IOTestCaseBulkLoader.PREFETCH_WORKERS)
         return self
+
+
+def prefetch_expected(test_cases: Iterable[IOTestCase], max_workers: int = 1):
+    """
+    Reads the expected output files of the given test cases into the shared
+    fixture cache ahead of execution, as the bytes that output checks compare
+    against. Files are read in inode order, which roughly follows their layout
+    on disk. Missing files are skipped and left for the test cases themselves
+    to report.
+
+    Expected files larger than a compare block, which output checks stream
+    from disk, and test input files, which are handed to the command as they
+    are, are not read. Instead the kernel is asked to start reading them into
+    the page cache ahead of time.
+
+    - max_workers: number of files stat()ed and read at once. On networked
+      storage, reading several files concurrently hides most of the latency.
+    """
+    # Whether each file is an expected output file, rather than only hinted.
+    expected = {}
+    for test_case in test_cases:
+        for path in (test_case.exp_stdout_path, test_case.exp_stderr_path):
+            if path:
+                expected[path] = True
+    for test_case in test_cases:
+        if test_case.input_path:
+            expected.setdefault(test_case.input_path, False)
+
+    def stat(path):
+        try:
+            return path, os.stat(path)
+        except FileNotFoundError:
+            return path, None
+
+    def load(item):
+        path, st = item
+        try:
+            if expected[path] and st.st_size <= CommandRunner.COMPARE_BLOCK_SIZE:
+                # Output checks compare bytes, whatever the test's I/O mode.
+                _read_file(path, True, st.st_mtime_ns)
+            elif hasattr(os, "posix_fadvise"):
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+        except (OSError, UnicodeDecodeError):
+            pass
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        stats = [item for item in pool.map(stat, expected) if item[1] and item[1].st_size]
+        stats.sort(key=lambda item: item[1].st_ino)
+        for _ in pool.map(load, stats):
+            pass
@@ -1,4 +1,13 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+
 class TestResultBase:
+    # A result is created for every execution; slots keep them small.
+    __slots__ = ("score", "passed", "timed_out", "error", "running_time", "has_run")
+
     def __init__(self):
         self.score: int = 0
         self.passed: bool = False
@@ -11,6 +20,10 @@ class TestResultBase:
 class TestCaseBase:
     DEFAULT_TIMEOUT = 10
 
+    # Whether execute() must be called on the thread that runs the suite,
+    # rather than on a pool thread, for its timeout to be enforced.
+    EXECUTE_ON_CALLER = False
+
     def __init__(
         self,
         name: str = "Test Case",
@@ -26,3 +39,34 @@ class TestCaseBase:
 
     def execute(self) -> TestResultBase:
         raise NotImplementedError
+
+
+def run_suite(
+    test_cases: Iterable[TestCaseBase], max_workers: Optional[int] = None
+):
+    """
+    Executes independent test cases concurrently on a thread pool.
+
+    - max_workers: defaults to the number of CPUs minus two (at least one).
+      With a single worker, test cases run in order on the calling thread.
+      Otherwise, test cases with EXECUTE_ON_CALLER set run on the calling
+      thread while the others run on the pool.
+    """
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) - 2)
+    if max_workers == 1:
+        for test_case in test_cases:
+            test_case.execute()
+        return
+    test_cases = list(test_cases)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(test_case.execute)
+            for test_case in test_cases
+            if not test_case.EXECUTE_ON_CALLER
+        ]
+        for test_case in test_cases:
+            if test_case.EXECUTE_ON_CALLER:
+                test_case.execute()
+        for future in futures:
+            future.result()